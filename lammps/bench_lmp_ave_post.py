@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Benchmarks lmp_ave_post.compute_mean and write_output against
+the former line by line parser and per element writer on a
+synthetic ave/chunk file.
+'''
+
+import argparse
+import numpy as np
+import os
+import tempfile
+import time
+
+import lmp_ave_post
+
+
+FIELDS = ['Chunk', 'Coord1', 'Ncount', 'v_vx', 'v_vy', 'v_temp']
+
+
+def write_synthetic(outfile, nrec, nentries):
+    rng = np.random.default_rng(0)
+    chunk = np.arange(1, nentries+1)
+    coord = (chunk - 0.5)/nentries
+    with open(outfile, 'w') as f:
+        f.write("# Chunk-averaged data for fix bench and group all\n")
+        f.write("# Timestep Number-of-chunks Total-count\n")
+        f.write("# {}\n".format(" ".join(FIELDS)))
+        for rec in range(nrec):
+            f.write("{} {} {}\n".format(1000*rec, nentries, 10*nentries))
+            values = rng.random((nentries, len(FIELDS)-2))
+            table = np.column_stack((chunk, coord, values))
+            np.savetxt(f, table, fmt=['%d'] + ['%.6f']*(len(FIELDS)-1))
+    return
+
+
+def legacy_mean(fields, infile):
+    '''
+    The per line map(float) parser compute_mean used to run.
+    '''
+    nfields = len(fields)
+    with open(infile, 'r') as f:
+        line = f.readline()
+        while line[0] == '#':
+            line = f.readline()
+        nentries = int(line.split()[1])
+        ave = np.zeros((nentries, nfields))
+        nrec = 0
+        while line:
+            for i in range(nentries):
+                line = list(map(float, f.readline().split()))
+                for j, k in enumerate(fields):
+                    ave[i, j] += line[j]
+            nrec += 1
+            line = f.readline()
+    return ave/nrec
+
+
+def legacy_write(outfile, fields, ave, sem):
+    '''
+    The per element str.format writer write_output used to run.
+    '''
+    with open(outfile, 'w') as f:
+        line = " ".join(('#', *["{:^17}"]*len(fields)))
+        f.write(''.join([line.format(*fields).rstrip(), '\n']))
+        for i, (a, s) in enumerate(zip(ave, sem)):
+            elems = []
+            for j, fi in enumerate(fields):
+                if fi in lmp_ave_post.SPECIAL_CASES:
+                    if fi == 'Chunk':
+                        elems.append("{:^17d}".format(i+1))
+                    else:
+                        elems.append("{:>12.6f} {:>12.6f}".format(a[j], 0.))
+                else:
+                    elems.append("{:>12.6f} {:>12.6f}".format(a[j], s[j]))
+            f.write(" ".join((*elems, '\n')))
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Times ave/chunk parsing, old and new."
+    )
+    parser.add_argument(
+        "--nrec",
+        dest="nrec",
+        default=200,
+        type=int,
+        help="Number of records [default %(default)s]"
+        )
+    parser.add_argument(
+        "--nentries",
+        dest="nentries",
+        default=5000,
+        type=int,
+        help="Number of chunks per record [default %(default)s]"
+        )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        infile = os.path.join(tmp, "bench.ave")
+        write_synthetic(infile, args.nrec, args.nentries)
+        print("File size: {:.1f} MB".format(os.path.getsize(infile)/1e6))
+
+        start = time.perf_counter()
+        ref = legacy_mean(FIELDS, infile)
+        t_legacy = time.perf_counter() - start
+
+        start = time.perf_counter()
+        ave, sem = lmp_ave_post.compute_mean(FIELDS, infile, 0, 0)
+        t_block = time.perf_counter() - start
+
+        outfile = os.path.join(tmp, "legacy.mean")
+        start = time.perf_counter()
+        legacy_write(outfile, FIELDS, ave, sem)
+        t_legacy_write = time.perf_counter() - start
+        with open(outfile, 'r') as f:
+            legacy_text = f.read()
+
+        outfile = os.path.join(tmp, "bulk.mean")
+        start = time.perf_counter()
+        lmp_ave_post.write_output(outfile, FIELDS, ave, sem)
+        t_bulk_write = time.perf_counter() - start
+        with open(outfile, 'r') as f:
+            same_output = f.read() == legacy_text
+
+    print("Line by line: {:8.3f} s".format(t_legacy))
+    print("Block parser: {:8.3f} s".format(t_block))
+    print("Speedup:      {:8.2f}".format(t_legacy/t_block))
+    print("Max abs diff: {:8.2e}".format(np.max(np.abs(ref - ave))))
+    print("Per element writer: {:8.3f} s".format(t_legacy_write))
+    print("Bulk writer:        {:8.3f} s".format(t_bulk_write))
+    print("Identical output:   {}".format(same_output))
+    return
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        raise SystemExit("User interruption.")
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Checks opls2ff on a small molecule without angles, dihedrals
+and impropers: every .ff section must still be written, the
+missing ones empty, alone and merged with another file.
+'''
+
+import os
+import subprocess
+import sys
+import tempfile
+
+
+OPLS2FF = os.path.join(os.path.dirname(os.path.abspath(__file__)), "opls2ff")
+SECTIONS = ["ATOMS", "BONDS", "ANGLES", "DIHEDRALS", "IMPROPERS"]
+
+DIATOMIC = '''LAMMPS data file via lpg
+
+2 atoms
+1 bonds
+
+2 atom types
+1 bond types
+
+0 10 xlo xhi
+0 10 ylo yhi
+0 10 zlo zhi
+
+Masses # amu
+
+1 12.0110 # C0
+2 15.9994 # O0
+
+Pair Coeffs
+
+1 0.066 3.500
+2 0.210 2.960
+
+Bond Coeffs
+
+1 570.0 1.128
+
+Atoms # full
+
+1 1 1 0.02 0.0 0.0 0.0
+2 1 2 -0.02 1.128 0.0 0.0
+
+Bonds
+
+1 1 1 2
+'''
+
+
+def read_sections(infile):
+    '''
+    Lines of every section of a .ff file, comments left out.
+    '''
+    sections = {}
+    lines = None
+    with open(infile, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line in SECTIONS:
+                lines = sections[line] = []
+            elif line and not line.startswith('#') and lines is not None:
+                lines.append(line)
+    return sections
+
+
+def run(*inputs, outfile):
+    proc = subprocess.run(
+            [sys.executable, OPLS2FF, "-i", *inputs, "-o", outfile, "-j", "2"],
+            capture_output=True, text=True,
+            )
+    return proc.returncode, proc.stderr
+
+
+def check(name, sections, expected):
+    failed = False
+    if list(sections) != SECTIONS:
+        print("{}: sections {} instead of {}".format(name, list(sections), SECTIONS))
+        failed = True
+    for section, nlines in expected.items():
+        found = len(sections.get(section, []))
+        if found != nlines:
+            print("{}: {} lines in {}, {} expected".format(name, found, section, nlines))
+            failed = True
+    return failed
+
+
+def main():
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        infile = os.path.join(tmp, "co.lmp")
+        with open(infile, 'w') as f:
+            f.write(DIATOMIC)
+        expected = {"ATOMS": 2, "BONDS": 1, "ANGLES": 0, "DIHEDRALS": 0, "IMPROPERS": 0}
+
+        outfile = os.path.join(tmp, "co.ff")
+        code, err = run(infile, outfile=outfile)
+        if code:
+            print("single file: exit status {}\n{}".format(code, err))
+            failed = True
+        else:
+            failed |= check("single file", read_sections(outfile), expected)
+
+        # The same file twice merges into the same entries,
+        # a missing one is reported without stopping the merge
+        outfile = os.path.join(tmp, "merged.ff")
+        missing = os.path.join(tmp, "missing.lmp")
+        code, err = run(infile, infile, missing, outfile=outfile)
+        if code != 1 or "missing.lmp" not in err:
+            print("merge: exit status {}, 1 expected\n{}".format(code, err))
+            failed = True
+        failed |= check("merge", read_sections(outfile), expected)
+
+    print("FAILED" if failed else "OK")
+    if failed:
+        sys.exit(1)
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -7,10 +7,27 @@ and returns average and sem.
 '''
 
 import argparse
+import glob
 import numpy as np
 import sys
 import os
 import logging
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import lmp_io
+
+
+CACHE_BATCH = 256  # Records reduced at once from the binary cache
+WRITE_BATCH = 4096  # Rows formatted at once by write_output
+SPECIAL_CASES = [
+        'Chunk',
+        'OrigID',
+        'Coord1',
+        'Coord2',
+        'Coord3'
+        ]
+MIN_BLOCKS = 16  # Blocking levels with less blocks are too noisy
 
 
 def get_fields(infile, is_non_standard):
@@ -22,146 +39,555 @@ def get_fields(infile, is_non_standard):
     if is_non_standard:
         fields = ['']
     else:
-        with open(infile, 'r') as f:
-            f.readline()
-            f.readline()
-            line = f.readline()
-            fields = line[1:].split()
+        fields = lmp_io.read_fields(infile)
     logging.debug(fields)
 
     return fields
 
 
-def compute_mean(fields, infile, stepmin, stepmax):
+class RunningStats:
+    '''
+    Running mean and sum of squared deviations (Welford).
+    All the cells of a record share the same count, so
+    count is a scalar and mean/m2 are (nentries, nfields).
+    '''
+    def __init__(self, shape):
+        self.count = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    def update(self, record):
+        self.count += 1
+        delta = record - self.mean
+        self.mean += delta/self.count
+        self.m2 += delta*(record - self.mean)
+
+    def update_many(self, records):
+        '''
+        Adds a (nrec, nentries, nfields) stack of records.
+        '''
+        other = RunningStats(records.shape[1:])
+        other.count = records.shape[0]
+        other.mean = records.mean(axis=0)
+        other.m2 = ((records - other.mean)**2).sum(axis=0)
+        self.merge(other)
+
+    def merge(self, other):
+        '''
+        Merges another accumulator in place (Chan et al.).
+        '''
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count = other.count
+            self.mean = other.mean.copy()
+            self.m2 = other.m2.copy()
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta*other.count/count
+        self.m2 += other.m2 + delta**2*self.count*other.count/count
+        self.count = count
+
+    def sem(self):
+        # Kept as sqrt(sum((x-ave)^2)/nrec) for compatibility
+        return np.sqrt(self.m2/self.count)
+
+
+class BlockingStats:
+    '''
+    Flyvbjerg-Petersen blocking analysis in bounded memory.
+    Level k accumulates averages of 2**k consecutive records,
+    so only log2(nrec) RunningStats and pending records are kept.
+    '''
+    def __init__(self, shape):
+        self.shape = shape
+        self.levels = []
+        self.pending = []
+
+    @property
+    def count(self):
+        return self.levels[0].count if self.levels else 0
+
+    @property
+    def mean(self):
+        return self.levels[0].mean if self.levels else np.zeros(self.shape)
+
+    def update(self, record):
+        value = np.array(record, dtype=float)
+        level = 0
+        while value is not None:
+            if level == len(self.levels):
+                self.levels.append(RunningStats(self.shape))
+                self.pending.append(None)
+            self.levels[level].update(value)
+            if self.pending[level] is None:
+                self.pending[level] = value
+                value = None
+            else:
+                value = 0.5*(self.pending[level] + value)
+                self.pending[level] = None
+            level += 1
+
+    def update_many(self, records):
+        for record in records:
+            self.update(record)
+
+    def sem(self):
+        '''
+        True sem of each cell, taken at the first blocking level
+        where the estimate reaches a plateau, i.e. where the next
+        level agrees within its statistical error. Levels with less
+        than MIN_BLOCKS blocks are not considered.
+        '''
+        levels = [s for s in self.levels if s.count >= MIN_BLOCKS]
+        if not levels:
+            levels = self.levels[:1]
+        counts = np.array([s.count for s in levels], dtype=float)
+        counts = counts.reshape(-1, *[1]*len(self.shape))
+        m2 = np.array([s.m2 for s in levels])
+        sems = np.sqrt(m2/(counts*np.maximum(counts-1, 1)))
+        if len(levels) == 1:
+            return sems[0]
+        errs = sems/np.sqrt(2*np.maximum(counts-1, 1))
+        plateau = sems[1:] <= sems[:-1] + errs[:-1]
+        first = np.where(plateau.any(axis=0), plateau.argmax(axis=0), len(levels)-1)
+        if not plateau.any(axis=0).all():
+            logging.warning(
+                    "No sem plateau reached for some cells, "
+                    "the run is probably too short."
+                    )
+        return np.take_along_axis(sems, first[np.newaxis], axis=0)[0]
+
+    def neff(self, sem=None):
+        '''
+        Effective number of independent records: sample
+        variance over squared sem, at most the record count.
+        '''
+        if sem is None:
+            sem = self.sem()
+        base = self.levels[0]
+        var = base.m2/max(base.count-1, 1)
+        sem2 = sem**2
+        neff = np.full(self.shape, float(base.count))
+        np.divide(var, sem2, out=neff, where=sem2 > 0)
+        return np.minimum(neff, base.count)
+
+
+def new_stats(shape, blocking):
+    if blocking:
+        return BlockingStats(shape)
+    return RunningStats(shape)
+
+
+def reduce_cached(fields, cache, stepmin, stepmax, blocking=False):
     '''
-    Computes data ave and sem.
+    Reduces the memory-mapped records of the binary cache,
+    CACHE_BATCH records at a time.
     '''
-    # Skip through header
     nfields = len(fields)
-    with open(infile, 'r') as f:
-        line = f.readline()
-        while line[0] == '#':
-            line = f.readline()
-        # Initialisation
-        line = line.split()
-        step, nentries = int(line[0]), int(line[1])
-        nentries_ref = nentries
-        ave = np.zeros((nentries, nfields))
-        sem = np.zeros((nentries, nfields))
-        # Computing the averages
-        for i in range(nentries):
-            line = list(map(float, f.readline().split()))
-            for j, k in enumerate(fields):
-                ave[i, j] += line[j]
-        nrec = 1
-        while True:
-            try:
-                line = f.readline().split()
-                if not line:
-                    break
-                step, nentries = int(line[0]), int(line[1])
-                keep = True
-                if stepmin and step < stepmin:
-                    keep = False
+    selection = cache.select(stepmin, stepmax)
+    if not len(selection):
+        raise ValueError("No record found in the requested step range.")
+    logging.info("Reading {} records from binary cache.".format(len(selection)))
+    stats = new_stats((cache.data.shape[1], nfields), blocking)
+    for start in range(0, len(selection), CACHE_BATCH):
+        batch = selection[start:start+CACHE_BATCH]
+        stats.update_many(cache.data[batch, :, :nfields])
+    return stats
+
+
+def partial_stats(infile, starts, ends, nrows, nfields):
+    '''
+    Accumulates the records lying in the given byte spans.
+    Run by the workers of reduce_parallel.
+    '''
+    stats = RunningStats((int(nrows[0]), nfields))
+    for record in lmp_io.read_spans(infile, starts, ends, nrows, nfields):
+        stats.update(record)
+    return stats
+
+
+def reduce_parallel(fields, infile, stepmin, stepmax, index, jobs):
+    '''
+    Splits the records of the step window into jobs ranges,
+    reduces them in a process pool and merges the partial
+    (count, mean, M2) accumulators.
+    '''
+    nfields = len(fields)
+    selection = index.select(stepmin, stepmax)
+    if not len(selection):
+        raise ValueError("No record found in the requested step range.")
+    nrows = index.nrows[selection]
+    changed = np.flatnonzero(nrows != nrows[0])
+    if changed.size:
+        raise ValueError(
+                "Entries number changed between records. Check entry t={:10.2f}."
+                .format(index.steps[selection[changed[0]]])
+                )
+    starts, ends = index.spans(selection)
+    parts = np.array_split(np.arange(len(selection)), min(jobs, len(selection)))
+    logging.info(
+            "Reducing {} records with {} processes."
+            .format(len(selection), len(parts))
+            )
+    stats = RunningStats((int(nrows[0]), nfields))
+    with ProcessPoolExecutor(max_workers=len(parts)) as pool:
+        futures = [
+                pool.submit(
+                    partial_stats, infile, starts[p], ends[p], nrows[p], nfields
+                    )
+                for p in parts
+                ]
+        # Merged in submission order so that results are reproducible
+        for future in futures:
+            stats.merge(future.result())
+    return stats
+
+
+def reduce_serial(fields, infile, stepmin, stepmax, index=None, blocking=False):
+    nfields = len(fields)
+    nentries_ref = 0
+    stats = None
+    records = lmp_io.iter_records(infile, nfields, stepmin, stepmax, index)
+    for nrec, (step, record) in enumerate(records):
+        nentries = record.shape[0]
+        if stats is None:
+            nentries_ref = nentries
+            stats = new_stats((nentries, nfields), blocking)
+        if nrec % 1000 == 0:
+            logging.info(
+                    "Reading record number {:<10d}, step {:<10.2f}."
+                    .format(nrec, step)
+                    )
+        if nentries != nentries_ref:
+            raise ValueError(
+                    "Entries number changed between records. Check entry t={:10.2f}."
+                    .format(step)
+                    )
+        stats.update(record)
+
+    if stats is None:
+        raise ValueError("No record found in the requested step range.")
+    return stats
+
+
+def accumulate(fields, infile, stepmin, stepmax, index=None, jobs=1, blocking=False):
+    '''
+    Reduces the records of the step window in a single pass and
+    returns the accumulator (RunningStats, or BlockingStats if
+    blocking is set). Reads the binary cache when it is up to date,
+    index or not.
+    '''
+    cache = lmp_io.load_cache(infile)
+    if cache is not None:
+        return reduce_cached(fields, cache, stepmin, stepmax, blocking)
+    if jobs > 1 and blocking:
+        logging.warning("Blocking analysis cannot be split, running serially.")
+    elif jobs > 1:
+        if index is None:
+            index = lmp_io.load_index(infile, build=True)
+        if index is not None:
+            return reduce_parallel(fields, infile, stepmin, stepmax, index, jobs)
+        logging.warning("Compressed file cannot be split, running serially.")
+    return reduce_serial(fields, infile, stepmin, stepmax, index, blocking)
+
+
+def compute_mean(fields, infile, stepmin, stepmax, index=None, jobs=1):
+    '''
+    Computes data ave and sem in a single pass over the file.
+    '''
+    stats = accumulate(fields, infile, stepmin, stepmax, index, jobs)
+    logging.debug("Computed average over {:<10d} records.".format(stats.count))
+    return stats.mean, stats.sem()
+
+
+def follow(fields, infile, outfile, stepmin, stepmax, interval, idle=0,
+           blocking=False, binary=False):
+    '''
+    Keeps the accumulators in memory while the file is being written.
+    Newly appended complete records are added every interval seconds
+    and the output is rewritten when there were some. Stops after
+    idle seconds without growth (never if 0), after stepmax or on
+    user interruption.
+    '''
+    nfields = len(fields)
+    stats = None
+    pos = 0
+    nwritten = 0
+    last_growth = time.monotonic()
+    done = False
+    try:
+        while not done:
+            start = pos
+            for step, record, end in lmp_io.tail_records(infile, pos, nfields):
+                pos = end
                 if stepmax and step > stepmax:
+                    done = True
                     break
-                if nrec % 1000 == 0:
-                    logging.info(
-                            "Reading record number {:<10d}, step {:<10.2f}."
-                            .format(nrec, step)
-                            )
-                if nentries != nentries_ref:
-                    logging.error(
+                if stepmin and step < stepmin:
+                    continue
+                if stats is None:
+                    stats = new_stats(record.shape, blocking)
+                elif record.shape[0] != stats.mean.shape[0]:
+                    raise ValueError(
                             "Entries number changed between records. Check entry t={:10.2f}."
                             .format(step)
                             )
-                    sys.exit(1)
-                for i in range(nentries):
-                    if keep:
-                        line = list(map(float, f.readline().split()))
-                        for j, k in enumerate(fields):
-                            ave[i, j] += line[j]
-                    else:
-                        f.readline()
-                nrec += keep
-            except EOFError:
+                stats.update(record)
+            if pos > start:
+                last_growth = time.monotonic()
+            if stats is not None and stats.count > nwritten:
+                write_results(outfile, fields, stats, blocking, binary)
+                nwritten = stats.count
+                logging.info("Output updated with {} records.".format(nwritten))
+            if idle and time.monotonic() - last_growth > idle:
+                logging.info("No new record for {} s, stopping.".format(idle))
                 break
+            if not done:
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        logging.info("Stopped following {}.".format(infile))
+    if stats is None:
+        raise ValueError("No record found in the requested step range.")
+    if stats.count > nwritten:
+        write_results(outfile, fields, stats, blocking, binary)
+    return stats
+
+
+def write_results(outfile, fields, stats, blocking=False, binary=False):
+    '''
+    Writes the output (.neff file if blocking, .npz if binary) through
+    a temporary file, so that readers never see a half written output.
+    '''
+    tmpfile = "".join([outfile, '.tmp'])
+    sem = stats.sem()
+    write_output(tmpfile, fields, stats.mean, sem)
+    os.replace(tmpfile, outfile)
+    neff = None
+    if blocking:
+        neff = stats.neff(sem)
+        write_neff(tmpfile, fields, neff)
+        os.replace(tmpfile, "".join([outfile, '.neff']))
+    if binary:
+        write_binary(tmpfile, fields, stats.mean, sem, neff)
+        os.replace(tmpfile, "".join([outfile, '.npz']))
+    return
+
+
+def expand_inputs(patterns):
+    '''
+    Expands the globs of the input list, keeping order and
+    leaving patterns matching nothing as they are. The index
+    and cache files written next to the inputs are left out.
+    '''
+    sidecars = (lmp_io.INDEX_SUFFIX, lmp_io.CACHE_SUFFIX, lmp_io.META_SUFFIX)
+    infiles = []
+    for pattern in patterns:
+        matches = sorted(m for m in glob.glob(pattern) if not m.endswith(sidecars))
+        for infile in matches or [pattern]:
+            if infile not in infiles:
+                infiles.append(infile)
+    return infiles
+
+
+def batch_outputs(infiles, summary):
+    '''
+    .mean output of each file of a batch, and the error of the
+    files whose output would also be written by another file
+    (e.g. a.ave.gz and a.ave.xz) or is the summary.
+    '''
+    outputs = {}
+    writers = {os.path.abspath(summary): ["the summary"]}
+    for infile in infiles:
+        outfile = "".join([os.path.splitext(infile)[0], '.mean'])
+        outputs[infile] = outfile
+        writers.setdefault(os.path.abspath(outfile), []).append(infile)
+    errors = {}
+    for infile, outfile in outputs.items():
+        others = [w for w in writers[os.path.abspath(outfile)] if w != infile]
+        if others:
+            errors[infile] = "Output {} also written by {}.".format(
+                    outfile, ", ".join(others)
+                    )
+    return outputs, errors
+
 
-        logging.debug("Computes average over {:<10d} records.".format(nrec))
-        ave /= nrec
-        logging.info("Computing sem. Rereading file.")
-        # Computing sem
-        nrec = 0
-        f.seek(0)
-        line = f.readline()
-        while line[0] == '#':
-            line = f.readline()
-        while True:
+def process_file(infile, outfile, is_non_standard, stepmin, stepmax, blocking,
+                 cache, binary, index=False):
+    '''
+    Processes one file of a batch, writing its own .mean output.
+    Returns a summary row, failures included, and never exits.
+    '''
+    row = {
+            'file': infile,
+            'status': 'failed',
+            'nrec': 0,
+            'nchunks': 0,
+            'output': outfile,
+            'error': '',
+            }
+    try:
+        if not os.path.isfile(infile):
+            raise ValueError("Could not find file {}.".format(infile))
+        fields = get_fields(infile, is_non_standard)
+        if cache and lmp_io.load_cache(infile) is None:
+            lmp_io.build_cache(infile)
+        record_index = None
+        if index:
+            record_index = lmp_io.load_index(infile, build=True)
+        stats = accumulate(fields, infile, stepmin, stepmax, record_index, blocking=blocking)
+        write_results(outfile, fields, stats, blocking, binary)
+        row['status'] = 'ok'
+        row['nrec'] = stats.count
+        row['nchunks'] = stats.mean.shape[0]
+    except Exception as e:
+        row['error'] = str(e) or type(e).__name__
+    return row
+
+
+def process_batch(infiles, summary, is_non_standard, stepmin, stepmax, jobs,
+                  blocking, cache, binary, index=False):
+    '''
+    Processes a batch of files concurrently in a shared process pool.
+    Progress and failures are reported per file and a bad file
+    does not stop the others. Files sharing an output name are
+    not processed, as they would overwrite each other.
+    '''
+    rows = {}
+    outputs, errors = batch_outputs(infiles, summary)
+    for n, (infile, error) in enumerate(errors.items(), start=1):
+        rows[infile] = {
+                'file': infile, 'status': 'failed', 'nrec': 0,
+                'nchunks': 0, 'output': outputs[infile], 'error': error,
+                }
+        logging.error(
+                "[{:>4d}/{:<4d}] {} failed: {}"
+                .format(n, len(infiles), infile, error)
+                )
+    with ProcessPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        futures = {
+                pool.submit(
+                    process_file, infile, outputs[infile], is_non_standard,
+                    stepmin, stepmax, blocking, cache, binary, index
+                    ): infile
+                for infile in infiles if infile not in errors
+                }
+        for n, future in enumerate(as_completed(futures), start=len(errors)+1):
+            infile = futures[future]
             try:
-                line = line.split()
-                step, nentries = int(line[0]), int(line[1])
-                keep = True
-                if stepmin and step < stepmin:
-                    keep = False
-                if stepmax and step > stepmax:
-                    break
-                if nrec % 1000 == 0:
-                    logging.info(
-                            "Reading record number {:<10d}, step {:<10.2f}."
-                            .format(nrec, step)
-                            )
-                if nentries != nentries_ref:
-                    logging.error(
-                            "Entries number changed between records. Check entry t={:10.2f}."
-                            .format(step)
-                            )
-                    sys.exit(1)
-                for i in range(nentries):
-                    if keep:
-                        line = list(map(float, f.readline().split()))
-                        for j, k in enumerate(fields):
-                            sem[i, j] += (line[j] - ave[i, j])**2
-                    else:
-                        f.readline()
-                nrec += keep
-                line = f.readline()
-                if not line:
-                    break
-            except EOFError:
-                break
-    sem = np.sqrt(sem/nrec)
-    return ave, sem
+                row = future.result()
+            except Exception as e:
+                # Worker died (e.g. out of memory)
+                row = {
+                        'file': infile, 'status': 'failed', 'nrec': 0,
+                        'nchunks': 0, 'output': '', 'error': str(e),
+                        }
+            rows[infile] = row
+            if row['status'] == 'ok':
+                print(
+                    "[{:>4d}/{:<4d}] {} -> {} ({} records)"
+                    .format(n, len(infiles), infile, row['output'], row['nrec'])
+                    )
+            else:
+                logging.error(
+                        "[{:>4d}/{:<4d}] {} failed: {}"
+                        .format(n, len(infiles), infile, row['error'])
+                        )
+    write_summary(summary, [rows[infile] for infile in infiles])
+    nfailed = sum(row['status'] != 'ok' for row in rows.values())
+    print(
+        "{} files processed, {} failed. Summary in {}."
+        .format(len(infiles), nfailed, summary)
+        )
+    return rows
+
+
+def write_summary(outfile, rows):
+    with open(outfile, 'w') as f:
+        f.write("# {:<40} {:^7} {:>10} {:>8} {:<40} {}\n".format(
+            'file', 'status', 'nrec', 'nchunks', 'output', 'error'
+            ))
+        for row in rows:
+            line = "  {:<40} {:^7} {:>10d} {:>8d} {:<40} {}".format(
+                    row['file'], row['status'], row['nrec'],
+                    row['nchunks'], row['output'], row['error']
+                    )
+            f.write(''.join([line.rstrip(), '\n']))
+    return
 
 
 def write_output(outfile, fields, ave, sem):
     '''
-    Self-explaining
+    Writes ave and sem interleaved for each field. Special cases get
+    a zero sem and Chunk is replaced by the row number. Rows are
+    formatted WRITE_BATCH at a time with a single % operation.
     '''
-    SPECIAL_CASES = [
-            'Chunk',
-            'OrigID',
-            'Coord1',
-            'Coord2',
-            'Coord3'
-            ]
     logging.info("About to write output file.")
+    nentries = len(ave)
+    formats = []
+    columns = []
+    for j, fi in enumerate(fields):
+        if fi == 'Chunk':
+            formats.append("%s")
+            columns.append(["{:^17d}".format(i+1) for i in range(nentries)])
+        elif fi in SPECIAL_CASES:
+            formats.append("%12.6f %12.6f")
+            columns.extend((ave[:, j], np.zeros(nentries)))
+        else:
+            formats.append("%12.6f %12.6f")
+            columns.extend((ave[:, j], sem[:, j]))
+    table = np.empty((nentries, len(columns)), dtype=object)
+    for k, column in enumerate(columns):
+        table[:, k] = column
+    row = " ".join((*formats, '\n'))
     with open(outfile, 'w') as f:
         line = " ".join(('#', *["{:^17}"]*len(fields)))
         f.write(''.join([line.format(*fields).rstrip(), '\n']))
-        for i, (a, s) in enumerate(zip(ave, sem)):
-            # I found no nice way of doing this...
+        for start in range(0, nentries, WRITE_BATCH):
+            block = table[start:start+WRITE_BATCH]
+            f.write(row*len(block) % tuple(block.ravel().tolist()))
+    logging.info("DONE!")
+    return
+
+
+def write_binary(outfile, fields, ave, sem, neff=None):
+    '''
+    Same content as write_output in a .npz for downstream tools:
+    fields, ave and sem (zero for special cases), neff if any.
+    '''
+    sem = sem.copy()
+    for j, fi in enumerate(fields):
+        if fi in SPECIAL_CASES:
+            sem[:, j] = 0.
+    arrays = {
+            'fields': np.array(fields, dtype=str),
+            'ave': ave,
+            'sem': sem,
+            }
+    if neff is not None:
+        arrays['neff'] = neff
+    with open(outfile, 'wb') as f:
+        np.savez(f, **arrays)
+    return
+
+
+def write_neff(outfile, fields, neff):
+    '''
+    Writes the effective number of independent records of each cell.
+    '''
+    with open(outfile, 'w') as f:
+        line = " ".join(('#', *["{:^17}"]*len(fields)))
+        f.write(''.join([line.format(*fields).rstrip(), '\n']))
+        for i, n in enumerate(neff):
             elems = []
             for j, fi in enumerate(fields):
-                if fi in SPECIAL_CASES:
-                    if fi == 'Chunk':
-                        elems.append("{:^17d}".format(i+1))
-                    else:
-                        elems.append("{:>12.6f} {:>12.6f}".format(a[j], 0.))
+                if fi == 'Chunk':
+                    elems.append("{:^17d}".format(i+1))
                 else:
-                    elems.append("{:>12.6f} {:>12.6f}".format(a[j], s[j]))
+                    elems.append("{:>17.2f}".format(n[j]))
             line = " ".join((*elems, '\n'))
             f.write(line)
-    logging.info("DONE!")
     return
 
 
@@ -173,16 +599,19 @@ def main():
     parser.add_argument(
         "-f",
         "--file",
-        dest="infile",
-        default="",
-        help="File to process",
+        dest="infiles",
+        nargs='+',
+        default=[""],
+        help="File(s) or glob(s) to process. With several files, each one "
+        "gets its own .mean output and a summary table is written.",
     )
     parser.add_argument(
         "-o",
         "--output",
         dest="outfile",
-        default="output.mean",
-        help="Output file name.",
+        default=None,
+        help="Output file name [default output.mean]. A batch of files "
+        "writes next to each input instead.",
     )
     parser.add_argument(
         "--smin",
@@ -205,26 +634,123 @@ def main():
         action="store_true",
         help="Non standard LAMMPS headers.",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        default=1,
+        type=int,
+        help="Number of processes reducing the file, or processing files "
+        "concurrently if there are several [default %(default)s]"
+        )
+    parser.add_argument(
+        "--index",
+        dest="index",
+        action="store_true",
+        help="Build (or refresh) the record index sidecar file and use it.",
+    )
+    parser.add_argument(
+        "--cache",
+        dest="cache",
+        action="store_true",
+        help="Convert the file to a binary cache (if not up to date) and read it.",
+    )
+    parser.add_argument(
+        "--blocking",
+        dest="blocking",
+        action="store_true",
+        help="Autocorrelation aware sem from blocking analysis. "
+        "Effective sample counts go to OUTFILE.neff.",
+    )
+    parser.add_argument(
+        "--follow",
+        dest="follow",
+        action="store_true",
+        help="Follow a file still being written, updating the output.",
+    )
+    parser.add_argument(
+        "--interval",
+        dest="interval",
+        default=30.,
+        type=float,
+        help="Seconds between two updates in follow mode [default %(default)s]"
+        )
+    parser.add_argument(
+        "--idle",
+        dest="idle",
+        default=0.,
+        type=float,
+        help="Stop following after this many seconds without new record, "
+        "0 for never [default %(default)s]"
+        )
+    parser.add_argument(
+        "--binary",
+        dest="binary",
+        action="store_true",
+        help="Also write fields, ave and sem to OUTFILE.npz.",
+    )
+    parser.add_argument(
+        "--summary",
+        dest="summary",
+        default="summary.mean",
+        help="Summary table of a batch of files [default %(default)s]",
+    )
     args = parser.parse_args()
 
     ##########
     # Manage arguments
 
-    infile = args.infile
-    outfile = args.outfile
+    infiles = expand_inputs(args.infiles)
     stepmin = args.stepmin
     stepmax = args.stepmax
     is_non_standard = args.non_standard
 
+    if len(infiles) > 1:
+        if args.follow:
+            logging.error("Follow mode works on a single file.")
+            sys.exit(1)
+        if args.outfile:
+            logging.error("-o/--output works on a single file, "
+                          "each file of a batch gets its own .mean.")
+            sys.exit(1)
+        rows = process_batch(
+                infiles, args.summary, is_non_standard, stepmin, stepmax,
+                args.jobs, args.blocking, args.cache, args.binary, args.index
+                )
+        if any(row['status'] != 'ok' for row in rows.values()):
+            sys.exit(1)
+        return
+
+    infile = infiles[0]
+    outfile = args.outfile or "output.mean"
+
     if not os.path.isfile(infile):
         print("Could not find file {}.".format(infile))
         sys.exit()
 
     fields = get_fields(infile, is_non_standard)
 
-    ave, sem = compute_mean(fields, infile, stepmin, stepmax)
+    try:
+        if args.cache and lmp_io.load_cache(infile) is None:
+            lmp_io.build_cache(infile)
+
+        index = None
+        if args.index:
+            index = lmp_io.load_index(infile, build=True)
 
-    write_output(outfile, fields, ave, sem)
+        if args.follow:
+            follow(
+                fields, infile, outfile, stepmin, stepmax,
+                args.interval, args.idle, args.blocking, args.binary
+                )
+        else:
+            stats = accumulate(
+                    fields, infile, stepmin, stepmax, index, args.jobs, args.blocking
+                    )
+            write_results(outfile, fields, stats, args.blocking, args.binary)
+    except ValueError as e:
+        logging.error(e)
+        sys.exit(1)
 
     return
 
@@ -0,0 +1,532 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Readers shared by the scripts working on LAMMPS ave/* outputs.
+
+Records of an ave/chunk file are a header line (step, number
+of rows, ...) followed by the rows. A record index stores the
+byte offset, step and row count of every complete record so that
+step windows can be read without parsing what is outside of them.
+'''
+
+import gzip
+import io
+import logging
+import lzma
+import mmap
+import os
+import queue
+import threading
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+INDEX_SUFFIX = '.idx.npz'
+CACHE_SUFFIX = '.cache.npy'  # (nrec, nentries, ncols) float64 records
+META_SUFFIX = '.cache.npz'  # Steps and field names of the cache
+SCAN_CHUNK = 1 << 26  # Bytes scanned at once when looking for newlines
+STREAM_CHUNK = 1 << 20  # Bytes decompressed at once
+STREAM_QUEUE = 16  # Decompressed chunks waiting for the parser
+MAGIC = {
+        b'\x1f\x8b': 'gzip',
+        b'\xfd7zXZ\x00': 'xz',
+        b'\x28\xb5\x2f\xfd': 'zstd',
+        }
+
+
+def compression(infile):
+    '''
+    Compression format of infile from its magic bytes, None if plain.
+    '''
+    with open(infile, 'rb') as f:
+        head = f.read(6)
+    for magic, kind in MAGIC.items():
+        if head.startswith(magic):
+            return kind
+    return None
+
+
+def _open_compressed(infile, kind):
+    if kind == 'gzip':
+        return gzip.open(infile, 'rb')
+    if kind == 'xz':
+        return lzma.open(infile, 'rb')
+    if zstandard is None:
+        raise ValueError("Reading zstd file {} needs zstandard.".format(infile))
+    return zstandard.ZstdDecompressor().stream_reader(open(infile, 'rb'), closefd=True)
+
+
+class ThreadedDecompressor(io.RawIOBase):
+    '''
+    Raw stream fed by a background thread that decompresses
+    infile into a bounded queue, so that parsing overlaps with
+    decompression (zlib and lzma release the GIL).
+    '''
+    def __init__(self, infile, kind):
+        self._queue = queue.Queue(maxsize=STREAM_QUEUE)
+        self._chunk = memoryview(b'')
+        self._eof = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+                target=self._feed, args=(infile, kind), daemon=True
+                )
+        self._thread.start()
+
+    def _feed(self, infile, kind):
+        try:
+            with _open_compressed(infile, kind) as f:
+                while not self._stop.is_set():
+                    chunk = f.read(STREAM_CHUNK)
+                    if not chunk:
+                        break
+                    self._put(chunk)
+            self._put(b'')
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._chunk and not self._eof:
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                self._eof = True
+            self._chunk = memoryview(item)
+        n = min(len(b), len(self._chunk))
+        b[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+    def close(self):
+        self._stop.set()
+        super().close()
+
+
+def open_text(infile):
+    '''
+    Opens infile for reading as text, decompressing it on the fly
+    if it is gzip, xz or zstd compressed. Compressed streams
+    cannot seek.
+    '''
+    kind = compression(infile)
+    if kind is None:
+        return open(infile, 'r')
+    logging.info("Reading {} compressed file {}.".format(kind, infile))
+    raw = ThreadedDecompressor(infile, kind)
+    return io.TextIOWrapper(io.BufferedReader(raw, STREAM_CHUNK))
+
+
+def read_fields(infile):
+    '''
+    Field names from the third line of a standard LAMMPS header.
+    '''
+    with open_text(infile) as f:
+        f.readline()
+        f.readline()
+        line = f.readline()
+    return line[1:].split()
+
+
+def select_steps(steps, stepmin=0, stepmax=0):
+    '''
+    Indices of the steps in the window. As in the sequential
+    readers, everything after the first step above stepmax
+    is dropped.
+    '''
+    keep = np.ones(len(steps), dtype=bool)
+    if stepmax:
+        above = np.flatnonzero(steps > stepmax)
+        if above.size:
+            keep[above[0]:] = False
+    if stepmin:
+        keep &= steps >= stepmin
+    return np.flatnonzero(keep)
+
+
+def parse_header(line):
+    '''
+    Returns step and number of rows of a record header.
+    These values can be exported as float by LAMMPS.
+    '''
+    tokens = line.split()
+    return int(float(tokens[0])), int(float(tokens[1]))
+
+
+def read_block(f, nentries, nfields=None):
+    '''
+    Reads the nentries lines of a record in one go
+    and returns them as a (nentries, nfields) array.
+    '''
+    block = "".join([f.readline() for _ in range(nentries)])
+    return parse_block(block, nentries, nfields)
+
+
+def parse_block(block, nentries, nfields=None):
+    values = np.array(block.split(), dtype=float)
+    if values.size == 0 or values.size % nentries:
+        raise ValueError("Truncated or ragged record in file.")
+    return values.reshape(nentries, -1)[:, :nfields]
+
+
+def skip_block(f, nentries):
+    for _ in range(nentries):
+        f.readline()
+
+
+class RecordIndex:
+    '''
+    Byte offset, step and number of rows of every complete
+    record of a file. end is the offset right after the last
+    complete record.
+    '''
+    def __init__(self, offsets, steps, nrows, data_start, end):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.steps = np.asarray(steps, dtype=np.int64)
+        self.nrows = np.asarray(nrows, dtype=np.int64)
+        self.data_start = int(data_start)
+        self.end = int(end)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __repr__(self):
+        return "RecordIndex({} records, bytes {}-{})".format(
+                len(self), self.data_start, self.end
+                )
+
+    def spans(self, selection):
+        '''
+        Start and end byte offsets of the selected records.
+        '''
+        ends = np.append(self.offsets[1:], self.end)
+        return self.offsets[selection], ends[selection]
+
+    def select(self, stepmin=0, stepmax=0):
+        return select_steps(self.steps, stepmin, stepmax)
+
+
+def _newlines(mm, start, stop):
+    '''
+    Positions of the newlines of mm[start:stop].
+    '''
+    buf = np.frombuffer(mm, dtype=np.uint8, count=stop-start, offset=start)
+    positions = np.flatnonzero(buf == 10) + start
+    del buf  # mm cannot be closed while exported
+    return positions
+
+
+def build_index(infile):
+    '''
+    Scans the file once through mmap and returns its RecordIndex.
+    Only the newline positions and record headers are looked at.
+    An incomplete trailing record (file still being written)
+    is left out of the index.
+    '''
+    offsets, steps, nrows = [], [], []
+    with open(infile, 'rb') as fh:
+        size = os.fstat(fh.fileno()).st_size
+        if size == 0:
+            return RecordIndex(offsets, steps, nrows, 0, 0)
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # Skip through header
+            data_start = 0
+            while mm[data_start:data_start+1] == b'#':
+                eol = mm.find(b'\n', data_start)
+                if eol < 0:
+                    return RecordIndex(offsets, steps, nrows, size, size)
+                data_start = eol + 1
+
+            # nl holds the newlines of lines first_line.. of the data
+            scanned = data_start
+            first_line = 0
+            nl = np.empty(0, dtype=np.int64)
+            prev_last = data_start - 1
+            target = 0  # Line number of the next record header
+            end = data_start
+            while True:
+                while target >= first_line + len(nl) and scanned < size:
+                    if len(nl):
+                        prev_last = nl[-1]
+                    first_line += len(nl)
+                    stop = min(scanned + SCAN_CHUNK, size)
+                    nl = _newlines(mm, scanned, stop)
+                    scanned = stop
+                if target >= first_line + len(nl):
+                    break
+                k = target - 1 - first_line
+                start = prev_last + 1 if k < 0 else nl[k] + 1
+                header = mm[start:nl[target-first_line]]
+                if not header.strip():
+                    break
+                step, nrow = parse_header(header)
+                last = target + nrow
+                # Make sure the last row of the record is complete
+                while last >= first_line + len(nl) and scanned < size:
+                    stop = min(scanned + SCAN_CHUNK, size)
+                    more = _newlines(mm, scanned, stop)
+                    nl = np.concatenate((nl[target-first_line:], more))
+                    first_line = target
+                    scanned = stop
+                if last >= first_line + len(nl):
+                    break
+                offsets.append(start)
+                steps.append(step)
+                nrows.append(nrow)
+                end = nl[last-first_line] + 1
+                target = last + 1
+    logging.debug("Indexed {} records of {}.".format(len(offsets), infile))
+    return RecordIndex(offsets, steps, nrows, data_start, end)
+
+
+def index_file(infile):
+    return "".join([infile, INDEX_SUFFIX])
+
+
+def _stamp(infile):
+    st = os.stat(infile)
+    return st.st_mtime_ns, st.st_size
+
+
+def save_index(infile, index):
+    mtime, size = _stamp(infile)
+    try:
+        with open(index_file(infile), 'wb') as f:
+            np.savez(
+                    f,
+                    offsets=index.offsets,
+                    steps=index.steps,
+                    nrows=index.nrows,
+                    data_start=index.data_start,
+                    end=index.end,
+                    mtime=mtime,
+                    size=size,
+                    )
+    except OSError as e:
+        logging.warning("Could not save index of {}: {}".format(infile, e))
+    return
+
+
+def load_index(infile, build=False):
+    '''
+    Returns the RecordIndex from the sidecar file if it matches
+    the mtime and size of infile. Otherwise builds and saves it
+    if build is set, or returns None.
+    '''
+    mtime, size = _stamp(infile)
+    try:
+        with np.load(index_file(infile)) as idx:
+            if int(idx['mtime']) == mtime and int(idx['size']) == size:
+                return RecordIndex(
+                        idx['offsets'],
+                        idx['steps'],
+                        idx['nrows'],
+                        idx['data_start'],
+                        idx['end'],
+                        )
+            logging.info("Index of {} is outdated.".format(infile))
+    except (OSError, KeyError, ValueError):
+        pass
+    if not build:
+        return None
+    if compression(infile):
+        logging.info("No record index for compressed file {}.".format(infile))
+        return None
+    logging.info("Building record index of {}.".format(infile))
+    index = build_index(infile)
+    save_index(infile, index)
+    return index
+
+
+def read_spans(infile, starts, ends, nrows, nfields=None):
+    '''
+    Yields the (nrows, nfields) array of each record
+    lying between the starts and ends byte offsets.
+    '''
+    with open(infile, 'rb') as f:
+        for start, end, nrow in zip(starts, ends, nrows):
+            f.seek(start)
+            data = f.read(end - start)
+            body = data[data.index(b'\n')+1:]
+            yield parse_block(body, int(nrow), nfields)
+
+
+def _iter_indexed(infile, index, nfields, stepmin, stepmax):
+    selection = index.select(stepmin, stepmax)
+    starts, ends = index.spans(selection)
+    blocks = read_spans(infile, starts, ends, index.nrows[selection], nfields)
+    for step, block in zip(index.steps[selection], blocks):
+        yield int(step), block
+
+
+def _iter_stream(infile, nfields, stepmin, stepmax):
+    with open_text(infile) as f:
+        line = f.readline()
+        while line and line[0] == '#':
+            line = f.readline()
+        while line.strip():
+            step, nrow = parse_header(line)
+            if stepmax and step > stepmax:
+                break
+            if stepmin and step < stepmin:
+                skip_block(f, nrow)
+            else:
+                yield step, read_block(f, nrow, nfields)
+            line = f.readline()
+
+
+def tail_records(infile, pos=0, nfields=None):
+    '''
+    Yields (step, block, end) for the complete records found
+    after byte pos, end being the offset right after the record.
+    Stops at the first incomplete record (file still being
+    written), so that it is read again from its start later.
+    '''
+    if compression(infile):
+        raise ValueError("Cannot follow compressed file {}.".format(infile))
+    with open(infile, 'rb') as f:
+        f.seek(pos)
+        while True:
+            line = f.readline()
+            if not line.endswith(b'\n'):
+                return
+            if line.startswith(b'#') or not line.strip():
+                continue
+            step, nrow = parse_header(line)
+            rows = [f.readline() for _ in range(nrow)]
+            if rows and not rows[-1].endswith(b'\n'):
+                return
+            yield step, parse_block(b"".join(rows), nrow, nfields), f.tell()
+
+
+class RecordCache:
+    '''
+    Parsed records of a file, memory-mapped from the
+    binary cache written by build_cache.
+    '''
+    def __init__(self, data, steps, fields):
+        self.data = data
+        self.steps = steps
+        self.fields = fields
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __repr__(self):
+        return "RecordCache({} records of shape {})".format(
+                len(self), self.data.shape[1:]
+                )
+
+    def select(self, stepmin=0, stepmax=0):
+        return select_steps(self.steps, stepmin, stepmax)
+
+
+def cache_files(infile):
+    return "".join([infile, CACHE_SUFFIX]), "".join([infile, META_SUFFIX])
+
+
+def build_cache(infile, index=None):
+    '''
+    Converts the records of infile to a (nrec, nentries, ncols)
+    float64 .npy file next to it, plus steps and field names.
+    Records are written one by one through a memmap.
+    '''
+    if index is None:
+        index = load_index(infile, build=True)
+    if index is None:
+        raise ValueError("Cannot cache compressed file {}.".format(infile))
+    if not len(index):
+        raise ValueError("No complete record in {}.".format(infile))
+    changed = np.flatnonzero(index.nrows != index.nrows[0])
+    if changed.size:
+        raise ValueError(
+                "Entries number changed between records. Check entry t={}."
+                .format(index.steps[changed[0]])
+                )
+    datafile, metafile = cache_files(infile)
+    logging.info("Writing binary cache {}.".format(datafile))
+    selection = np.arange(len(index))
+    starts, ends = index.spans(selection)
+    records = read_spans(infile, starts, ends, index.nrows)
+    first = next(records)
+    tmpfile = "".join([datafile, '.tmp'])
+    data = np.lib.format.open_memmap(
+            tmpfile,
+            mode='w+',
+            dtype=np.float64,
+            shape=(len(index), *first.shape),
+            )
+    data[0] = first
+    for i, record in enumerate(records, start=1):
+        data[i] = record
+    data.flush()
+    del data
+    os.replace(tmpfile, datafile)
+    # Written last, its mtime tells the cache is complete
+    with open(metafile, 'wb') as f:
+        np.savez(
+                f,
+                steps=index.steps,
+                fields=np.array(read_fields(infile), dtype=str),
+                )
+    return load_cache(infile)
+
+
+def load_cache(infile):
+    '''
+    Returns the RecordCache of infile if it is fresher than
+    the text file, None otherwise. Data is memory-mapped.
+    '''
+    datafile, metafile = cache_files(infile)
+    try:
+        if os.stat(metafile).st_mtime_ns <= os.stat(infile).st_mtime_ns:
+            logging.info("Binary cache of {} is outdated.".format(infile))
+            return None
+        with np.load(metafile) as meta:
+            steps = meta['steps']
+            fields = [str(field) for field in meta['fields']]
+        data = np.load(datafile, mmap_mode='r')
+    except (OSError, KeyError, ValueError):
+        return None
+    if data.shape[0] != len(steps):
+        return None
+    return RecordCache(data, steps, fields)
+
+
+def _iter_cached(cache, nfields, stepmin, stepmax):
+    for i in cache.select(stepmin, stepmax):
+        yield int(cache.steps[i]), cache.data[i, :, :nfields]
+
+
+def iter_records(infile, nfields=None, stepmin=0, stepmax=0, index=None):
+    '''
+    Yields (step, (nrows, nfields) array) for every record of the
+    step window. Records come from the binary cache if it is fresher
+    than infile. Otherwise index, or the sidecar index if it is up to
+    date, is used to seek to the wanted records. Reads sequentially
+    when there is neither.
+    '''
+    if index is None:
+        cache = load_cache(infile)
+        if cache is not None:
+            return _iter_cached(cache, nfields, stepmin, stepmax)
+        index = load_index(infile)
+    if index is not None:
+        return _iter_indexed(infile, index, nfields, stepmin, stepmax)
+    return _iter_stream(infile, nfields, stepmin, stepmax)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Reader, checker and writer for LAMMPS pair_style table files.
+
+A table file holds one section per keyword: the keyword line,
+a parameter line (N npoints, R/RSQ rlo rhi, FPRIME...), a blank
+line and npoints "index r energy force" lines. The file is indexed
+once by byte offset so that only the requested sections are parsed.
+'''
+
+import logging
+import mmap
+import os
+
+import numpy as np
+
+import lmp_io
+
+
+class TableSection:
+    '''
+    Keyword, parameter tokens and byte span of the data lines
+    of one section of a table file.
+    '''
+
+    def __init__(self, keyword, params, npoints, start, stop):
+        self.keyword = keyword
+        self.params = params
+        self.npoints = npoints
+        self.start = start
+        self.stop = stop
+
+    def __repr__(self):
+        return "TableSection({}, {} points at {}:{})".format(
+                self.keyword, self.npoints, self.start, self.stop
+                )
+
+
+class Table:
+    '''
+    Distance, energy and force of one keyword.
+    '''
+
+    def __init__(self, keyword, params, r, energy, force):
+        self.keyword = keyword
+        self.params = params
+        self.r = r
+        self.energy = energy
+        self.force = force
+
+    def __len__(self):
+        return len(self.r)
+
+    def __repr__(self):
+        return "Table({}, {} points)".format(self.keyword, len(self))
+
+
+def index_table(buf):
+    '''
+    Returns the TableSection of every keyword of the table held
+    in buf (bytes or mmap). Newlines are located in one vectorized
+    pass, then only the keyword and parameter lines are decoded.
+    '''
+    view = np.frombuffer(buf, dtype=np.uint8)
+    nl = np.flatnonzero(view == 10)
+    del view  # An mmap cannot be closed while exported
+    if len(buf) and buf[-1:] != b'\n':
+        nl = np.append(nl, len(buf))
+    starts = np.concatenate(([0], nl[:-1] + 1))
+
+    def line(i):
+        return buf[starts[i]:nl[i]].partition(b'#')[0].strip()
+
+    sections = []
+    nlines = len(nl)
+    i = 0
+    while i < nlines:
+        keyword = line(i)
+        i += 1
+        if not keyword:
+            continue
+        if i >= nlines:
+            raise ValueError("Missing parameters of {}.".format(keyword.decode()))
+        params = line(i).decode().split()
+        i += 1
+        try:
+            npoints = int(params[params.index('N') + 1])
+        except (ValueError, IndexError):
+            raise ValueError("No N in parameters of {}.".format(keyword.decode()))
+        while i < nlines and not line(i):
+            i += 1
+        if i + npoints > nlines:
+            raise ValueError("Truncated section {}.".format(keyword.decode()))
+        sections.append(TableSection(
+                keyword.decode(), params, npoints, starts[i], nl[i+npoints-1]
+                ))
+        i += npoints
+    logging.debug("Indexed {} table sections.".format(len(sections)))
+    return sections
+
+
+def parse_section(buf, section):
+    '''
+    Parses the data lines of section in one go
+    and returns its distance, energy and force.
+    '''
+    values = np.array(buf[section.start:section.stop].split(), dtype=float)
+    if values.size != 4*section.npoints:
+        raise ValueError("Ragged section {}.".format(section.keyword))
+    values = values.reshape(section.npoints, 4)
+    return values[:, 1], values[:, 2], values[:, 3]
+
+
+def integrate_energy(r, force):
+    '''
+    Energy from the force by trapezoidal integration,
+    set to zero at the last point.
+    '''
+    e = np.zeros(r.shape)
+    np.cumsum(0.5*(force[1:] + force[:-1])*np.diff(r), out=e[1:])
+    return e[-1] - e
+
+
+def select_sections(sections, keywords=None):
+    '''
+    Sections matching keywords, in file order.
+    '''
+    if not keywords:
+        return sections
+    found = {s.keyword for s in sections}
+    for keyword in keywords:
+        if keyword not in found:
+            logging.warning("Keyword {} not found.".format(keyword))
+    return [s for s in sections if s.keyword in keywords]
+
+
+def _read_buffer(buf, keywords):
+    return [
+            Table(s.keyword, s.params, *parse_section(buf, s))
+            for s in select_sections(index_table(buf), keywords)
+            ]
+
+
+def read_table(infile, keywords=None):
+    '''
+    Returns the Table of each requested keyword, all of them by
+    default. Plain files are mapped in memory, compressed ones
+    are decompressed first.
+    '''
+    if lmp_io.compression(infile):
+        with lmp_io.open_text(infile) as f:
+            return _read_buffer(f.read().encode(), keywords)
+    with open(infile, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return _read_buffer(mm, keywords)
+
+
+def grid_params(params):
+    '''
+    Splits the parameter tokens of a section into the grid
+    keyword (R or RSQ) with its bounds and the other tokens.
+    '''
+    grid, others = None, []
+    tokens = iter(params)
+    for tok in tokens:
+        if tok == 'N':
+            next(tokens)
+        elif tok in ('R', 'RSQ'):
+            grid = (tok, float(next(tokens)), float(next(tokens)))
+        elif tok == 'BITMAP':
+            raise ValueError("BITMAP tables are not supported.")
+        else:
+            others.append(tok)
+    return grid, others
+
+
+def _gap(approx, exact):
+    # Relative, absolute where values are below 1
+    return np.abs(approx - exact)/np.maximum(np.abs(exact), 1.)
+
+
+def force_error(table):
+    '''
+    Largest gap between the force column and -dE/dr of the
+    energy column (relative, absolute below 1), and where it is.
+    '''
+    gap = _gap(-np.gradient(table.energy, table.r, edge_order=2), table.force)
+    i = np.argmax(gap)
+    return gap[i], table.r[i]
+
+
+def regrid(table, npoints, rsq=None):
+    '''
+    Table interpolated on npoints, evenly spaced in r,
+    or in r^2 if rsq is set. By default, the spacing
+    (R or RSQ) of table is kept.
+    '''
+    grid, others = grid_params(table.params)
+    if rsq is None:
+        rsq = grid is not None and grid[0] == 'RSQ'
+    rlo, rhi = table.r[0], table.r[-1]
+    if rsq:
+        r = np.sqrt(np.linspace(rlo**2, rhi**2, npoints))
+    else:
+        r = np.linspace(rlo, rhi, npoints)
+    # Keeps the bounds exact
+    r[0], r[-1] = rlo, rhi
+    bounds = ['{:.16g}'.format(rlo), '{:.16g}'.format(rhi)]
+    params = ['N', str(npoints), 'RSQ' if rsq else 'R'] + bounds + others
+    return Table(
+            table.keyword,
+            params,
+            r,
+            np.interp(r, table.r, table.energy),
+            np.interp(r, table.r, table.force),
+            )
+
+
+def resample_error(table, coarse):
+    '''
+    Error on energy and force of the linear interpolation
+    of coarse at the points of table.
+    '''
+    return max(
+            np.max(_gap(np.interp(table.r, coarse.r, coarse.energy), table.energy)),
+            np.max(_gap(np.interp(table.r, coarse.r, coarse.force), table.force)),
+            )
+
+
+def resample(table, npoints=None, tol=None, rsq=None):
+    '''
+    Table regridded on npoints, or on the fewest points keeping
+    the resample_error below tol (bisection, never more points
+    than table has). If even as many points as table does not
+    reach tol, table itself is returned.
+    '''
+    if npoints:
+        return regrid(table, npoints, rsq)
+    if tol is None:
+        raise ValueError("Either a number of points or a tolerance is needed.")
+    lo, hi = 2, len(table)
+    best = regrid(table, hi, rsq)
+    if resample_error(table, best) > tol:
+        logging.warning("{}: tolerance not reached with {} points, table kept as is."
+                        .format(table.keyword, hi))
+        return table
+    while hi - lo > 1:
+        mid = (lo + hi)//2
+        coarse = regrid(table, mid, rsq)
+        if resample_error(table, coarse) > tol:
+            lo = mid
+        else:
+            hi, best = mid, coarse
+    return best
+
+
+def write_table(outfile, tables, comment=""):
+    '''
+    Writes tables as a LAMMPS pair_style table file.
+    '''
+    with open(outfile, 'w') as f:
+        f.write("# {}\n\n".format(comment))
+        for table in tables:
+            f.write("{}\n{}\n\n".format(table.keyword, " ".join(table.params)))
+            rows = np.column_stack((
+                np.arange(1, len(table) + 1), table.r, table.energy, table.force
+                ))
+            np.savetxt(f, rows, fmt="%d %.16e %.16e %.16e")
+            f.write("\n")
+    return
+
+
+def write_plot(outfile, table, infile):
+    '''
+    Writes r, energy and force of a table as columns.
+    '''
+    with open(outfile, 'w') as f:
+        f.write("# {} force extracted from {}\n".format(table.keyword, infile))
+        f.write("# {:^20} {:^20} {:^20}\n".format('r', 'energy', 'force'))
+        rows = np.column_stack((table.r, table.energy, table.force))
+        np.savetxt(f, rows, fmt="%18.16e")
+    return
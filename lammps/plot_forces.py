@@ -10,20 +10,167 @@ import numpy as np
 import os
 import logging
 import sys
-from matplotlib import pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+
+import lmp_table
+
+try:
+    import utilsscript
+except ImportError:
+    utilsscript = None
+
+KB = 0.001985875  # kcal/K/mol
 
 
 def compute_energy(tp):
-    r = tp[0]
-    fo = tp[2]
-    e = np.zeros(r.shape)
-    for i, (ri, fi) in enumerate(zip(r, fo)):
-        if i == 0:
-            continue
-        dr = ri - r[i-1]
-        e[i] = e[i-1]-dr*fo[i-1]
-    e -= e[-1]
-    return e
+    return lmp_table.integrate_energy(tp[0], tp[2])
+
+
+def plot_tables(toplot, outfile="", temp=-1, xrange="", yrange=""):
+    '''
+    Energy and force of the tables side by side, shown or saved to
+    outfile with the Agg backend. Nothing from matplotlib is loaded
+    unless a plot is asked for.
+    '''
+    import matplotlib
+    if outfile:
+        matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+
+    fig, axes = plt.subplots(1, 2)
+
+    for tp in toplot:
+        axes[0].plot(tp[0], tp[1], label=tp[3], linewidth=3)
+        axes[1].plot(tp[0], tp[2], label=tp[3], linewidth=3)
+        hmin, hmax = axes[1].get_xlim()
+        axes[1].hlines(0, hmin, hmax, color="black", linewidth=3, linestyles="dashdot")
+
+    if temp > 0:
+        hmin, hmax = axes[0].get_xlim()
+        axes[0].hlines(KB*temp, hmin, hmax, color="orange", label=r'$k_BT$', linewidth=3, linestyles="dashdot")
+
+    if xrange:
+        xmin, xmax = list(map(float, xrange.split(":")))
+        axes[0].set_xlim(xmin, xmax)
+        axes[1].set_xlim(xmin, xmax)
+    if yrange:
+        ymin, ymax = list(map(float, yrange.split(":")))
+        axes[0].set_ylim(ymin, ymax)
+        axes[1].set_ylim(ymin, ymax)
+
+    font = "Hack"
+    fontsize = 30
+
+    # Setting axes 0
+    axes[0].set_title("Estimated energy", fontsize=fontsize)
+    # axes[0].legend(frameon=False, fontsize=fontsize)  # Fat font, no frame
+    axes[0].set_xlabel("r [A]", fontname=font, fontsize=fontsize)  # ylabel name, font is Hack, size 30pts
+    axes[0].set_ylabel("E [kcal/mol]", fontname=font, fontsize=fontsize)  # ylabel name, font is Hack, size 30pts
+    axes[0].tick_params(axis='both', which='major', labelsize=fontsize)  # Biggers ticks, bigger ticks label!
+
+    # Setting axes 1
+    axes[1].set_title("Tabulated force", fontsize=fontsize)
+    axes[1].legend(frameon=False, fontsize=fontsize)  # Fat font, no frame
+    axes[1].set_xlabel("r [A]", fontname=font, fontsize=fontsize)  # ylabel name, font is Hack, size 30pts
+    axes[1].set_ylabel("F [kcal/mol/A]", fontname=font, fontsize=fontsize)  # ylabel name, font is Hack, size 30pts
+    axes[1].tick_params(axis='both', which='major', labelsize=fontsize)  # Biggers ticks, bigger ticks label!
+
+    plt.subplots_adjust(wspace=0.3)
+    if outfile:
+        fig.savefig(outfile)
+        plt.close(fig)
+    else:
+        plt.show()
+    return
+
+
+def output_name(name, infile, several):
+    '''
+    name itself for a single input file, prefixed by the
+    input file name when several are processed.
+    '''
+    if not several:
+        return name
+    base = os.path.splitext(os.path.basename(infile))[0]
+    return "_".join([base, name])
+
+
+def process_file(infile, args, several=False):
+    '''
+    Checks, resamples, extracts and plots the tables of infile as
+    asked in args. Returns the report lines, raises ValueError if
+    the file cannot be read.
+    '''
+    if not os.path.isfile(infile):
+        raise ValueError("Input file not found")
+    # Only the sections of the wanted keywords are parsed
+    tables = lmp_table.read_table(infile, args.keywords)
+    for t in tables:
+        logging.info("Found {} token".format(t.keyword))
+
+    report = []
+    if args.check:
+        for t in tables:
+            gap, r = lmp_table.force_error(t)
+            report.append("{}: {} points, largest |F + dE/dr| error {:.3e} at r = {:g}".format(
+                t.keyword, len(t), gap, r
+                ))
+    if args.resample:
+        resampled = [
+                lmp_table.resample(t, args.npoints, args.tol, args.rsq)
+                for t in tables
+                ]
+        for t, new in zip(tables, resampled):
+            report.append("{}: {} -> {} points, error {:.3e}".format(
+                t.keyword, len(t), len(new), lmp_table.resample_error(t, new)
+                ))
+        outfile = output_name(args.resample, infile, several)
+        lmp_table.write_table(outfile, resampled, "Resampled from {}".format(infile))
+    # Check and resample modes only plot to a file given by -o
+    plot = not args.noplot and (args.output or not (args.check or args.resample))
+    if not (args.extract or plot):
+        return report
+
+    toplot = [[t.r, t.energy, t.force, t.keyword] for t in tables]
+    for tp in toplot:
+        tp[1] = compute_energy(tp)
+
+    if args.extract:
+        for tp in toplot:
+            outfile = output_name("".join([tp[3], '.plot']), infile, several)
+            logging.info("Writing file {}".format(outfile))
+            table = lmp_table.Table(tp[3], [], tp[0], tp[1], tp[2])
+            lmp_table.write_plot(outfile, table, infile)
+            report.append("{} written.".format(outfile))
+
+    if plot:
+        outfile = output_name(args.output, infile, several) if args.output else ""
+        plot_tables(toplot, outfile, args.temp, args.xrange, args.yrange)
+        if outfile:
+            report.append("{} written.".format(outfile))
+    return report
+
+
+def run(infile, args, several):
+    # Errors are returned so that one bad file does not stop a batch
+    try:
+        return infile, process_file(infile, args, several), None
+    except ValueError as e:
+        return infile, [], str(e)
+
+
+def report_file(infile, report, error, several=False):
+    '''
+    Prints the report of infile, returns True if it failed.
+    '''
+    if error:
+        logging.error("{}: {}".format(infile, error))
+        return True
+    if several and report:
+        print("{}:".format(infile))
+    for line in report:
+        print(line)
+    return False
 
 
 def main():
@@ -42,9 +189,10 @@ def main():
     parser.add_argument(
         "-f",
         "--file",
-        dest="infile",
-        default="",
-        help="File to read",
+        dest="infiles",
+        default=[],
+        nargs='+',
+        help="Files to read",
     )
     parser.add_argument(
         "-x",
@@ -70,107 +218,105 @@ def main():
         action="store_true",
         help="Extract the forces in separate files",
     )
+    parser.add_argument(
+        "-k",
+        "--keywords",
+        dest="keywords",
+        default=None,
+        nargs='+',
+        help="Keywords of the tables to read [default all]",
+    )
+    parser.add_argument(
+        "-c",
+        "--check",
+        dest="check",
+        action="store_true",
+        help="Report the largest error between force and -dE/dr, "
+        "no plot unless -o is given",
+    )
+    parser.add_argument(
+        "-r",
+        "--resample",
+        dest="resample",
+        default="",
+        help="Write the tables resampled (see -n, --tol) to this file, "
+        "no plot unless -o is given",
+    )
+    parser.add_argument(
+        "-n",
+        "--npoints",
+        dest="npoints",
+        default=0,
+        type=int,
+        help="Number of points of the resampled tables",
+    )
+    parser.add_argument(
+        "--tol",
+        dest="tol",
+        default=1e-4,
+        type=float,
+        help="Largest relative error (absolute below 1) of the resampled "
+        "tables when -n is not given [default %(default)s]",
+    )
+    parser.add_argument(
+        "--rsq",
+        dest="rsq",
+        default=None,
+        action="store_true",
+        help="Resample evenly in r^2 (RSQ) [default the spacing of each table]",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="output",
+        default="",
+        help="Save the plot to this file instead of showing it (no display needed)",
+    )
+    parser.add_argument(
+        "--no-plot",
+        dest="noplot",
+        action="store_true",
+        help="Do not plot, matplotlib is not even loaded",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        default=os.cpu_count(),
+        type=int,
+        help="Files processed in parallel when nothing is shown [default %(default)s]",
+    )
     args = parser.parse_args()
 
     ##########
     # Manage arguments
 
     # -v/--verbose
-
-    kb = 0.001985875  # kcal/K/mol
-
-    try:
+    if utilsscript is not None:
         utilsscript.init_logging(args.verbosity)
-    except NameError:
+    else:
         logging.basicConfig(level=logging.WARNING)
         logging.warning("utilsscript lib not found, using default logging at warning level.")
 
-    infile = args.infile
-    if not os.path.isfile(infile):
+    if not args.infiles:
         logging.error("Input file not found")
         sys.exit(1)
 
-    toplot = []
-    with open(infile, 'r') as f:
-        lines = iter(f.readlines())
-        while True:
-            try:
-                r = []
-                force = []
-                ener = []
-                tok = []
-                while not tok:
-                    tok = next(lines).partition('#')[0].rstrip()
-                logging.info("Found {} token".format(tok))
-                infos = next(lines).split()
-                npoints = int(infos[1])
-                next(lines)
-                for i in range(npoints):
-                    line = next(lines).split()
-                    r.append(float(line[1]))
-                    ener.append(float(line[2]))
-                    force.append(float(line[3]))
-                r = np.array(r)
-                ener = np.array(ener)
-                force = np.array(force)
-                toplot.append([r, ener, force, tok])
-                tok = []
-                next(lines)
-            except StopIteration:
-                break
-    for tp in toplot:
-        tp[1] = compute_energy(tp)
-
-    fig, axes = plt.subplots(1, 2)
-
-    for tp in toplot:
-        axes[0].plot(tp[0], tp[1], label=tp[3], linewidth=3)
-        axes[1].plot(tp[0], tp[2], label=tp[3], linewidth=3)
-        hmin, hmax = axes[1].get_xlim()
-        axes[1].hlines(0, hmin, hmax, color="black", linewidth=3, linestyles="dashdot")
-
-    if args.temp > 0:
-        hmin, hmax = axes[0].get_xlim()
-        axes[0].hlines(kb*args.temp, hmin, hmax, color="orange", label=r'$k_BT$', linewidth=3, linestyles="dashdot")
-
-    if args.xrange:
-        xmin, xmax = list(map(float, args.xrange.split(":")))
-        axes[0].set_xlim(xmin, xmax)
-        axes[1].set_xlim(xmin, xmax)
-    if args.yrange:
-        ymin, ymax = list(map(float, args.yrange.split(":")))
-        axes[0].set_ylim(ymin, ymax)
-        axes[1].set_ylim(ymin, ymax)
-
-    font = "Hack"
-    fontsize = 30
-
-    # Setting axes 0
-    axes[0].set_title("Estimated energy", fontsize=fontsize)
-    # axes[0].legend(frameon=False, fontsize=fontsize)  # Fat font, no frame
-    axes[0].set_xlabel("r [A]", fontname=font, fontsize=fontsize)  # ylabel name, font is Hack, size 30pts
-    axes[0].set_ylabel("E [kcal/mol]", fontname=font, fontsize=fontsize)  # ylabel name, font is Hack, size 30pts
-    axes[0].tick_params(axis='both', which='major', labelsize=fontsize)  # Biggers ticks, bigger ticks label!
-
-    # Setting axes 1
-    axes[1].set_title("Tabulated force", fontsize=fontsize)
-    axes[1].legend(frameon=False, fontsize=fontsize)  # Fat font, no frame
-    axes[1].set_xlabel("r [A]", fontname=font, fontsize=fontsize)  # ylabel name, font is Hack, size 30pts
-    axes[1].set_ylabel("F [kcal/mol/A]", fontname=font, fontsize=fontsize)  # ylabel name, font is Hack, size 30pts
-    axes[1].tick_params(axis='both', which='major', labelsize=fontsize)  # Biggers ticks, bigger ticks label!
-
-    plt.subplots_adjust(wspace=0.3)
-    plt.show()
-
-    if args.extract:
-        for tp in toplot:
-            outfile = "".join([tp[3], '.plot'])
-            logging.info("Writing file {}".format(outfile))
-            with open(outfile, 'w') as f:
-                f.write("# {} force extracted from {}\n".format(tp[3], infile))
-                f.write("# {:^20} {:^20} {:^20}\n".format('r', 'energy', 'force'))
-                for a, b, c in zip(tp[0], tp[1], tp[2]):
-                    f.write("{:>18.16e} {:>18.16e} {:>18.16e}\n".format(a, b, c))
+    several = len(args.infiles) > 1
+    interactive = not (args.noplot or args.output or args.check or args.resample)
+    failed = False
+    if interactive or args.jobs < 2 or not several:
+        # Windows are shown one file after the other
+        results = (run(infile, args, several) for infile in args.infiles)
+        for infile, report, error in results:
+            failed |= report_file(infile, report, error, several)
+    else:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = [pool.submit(run, infile, args, several) for infile in args.infiles]
+            for future in futures:
+                failed |= report_file(*future.result(), several)
+    if failed:
+        sys.exit(1)
     return
 
 
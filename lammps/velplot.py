@@ -1,83 +1,340 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+'''
+Plots the 2d velocity field of a LAMMPS ave/chunk output on 2d bins.
+Also usable as a library through velocity_field.
+'''
+
+import argparse
+import logging
 import numpy as np
 import matplotlib as mpl
 from matplotlib import pyplot as plt
 
-class Smallbox:
-    def __init__(self):
-        self.x = 0.
-        self.y = 0.
-        self.vx = 0.
-        self.vy = 0.
-        self.atoms = 0.
-        self.temp = 0.
+import lmp_io
+
+# Default column of each quantity in the ave/chunk rows
+COLUMNS = {
+        'chunk': 0,
+        'x': 1,
+        'y': 2,
+        'atoms': 3,
+        'vx': 4,
+        'vy': 5,
+        'temp': 6,
+        }
+SUMMED = ['vx', 'vy', 'atoms', 'temp']
+WEIGHTED = ['vx', 'vy', 'temp']
+
+
+class ChunkAccumulator:
+    '''
+    Struct of arrays summing a 2d velocity field over the records
+    of an ave/chunk file, one whole record at a time. Arrays are
+    indexed by chunk id - 1. The first nonzero x/y of a chunk is
+    kept as its coordinate. If weighted, velocities and temperature
+    are summed times the atom count of the chunk.
+    '''
+    def __init__(self, nchunks, columns=COLUMNS, weighted=False):
+        self.columns = columns
+        self.weighted = weighted
+        self.nrec = 0
+        self.x = np.zeros(nchunks)
+        self.y = np.zeros(nchunks)
+        self.sums = {}
+        for name in SUMMED:
+            self.sums[name] = np.zeros(nchunks)
+
     def __repr__(self):
-        return "{} {} {} {} {}".format(self.x, self.y, self.vx, self.vy, self.atoms)
-
-def read_file(filename):
-    with open(filename, 'r') as f:
-        for _ in range(3): f.readline()
-        head = f.readline().split()
-        nentries = int(head[1])
-        boxes = []
-        for _ in range(nentries):
-            boxes.append(Smallbox())
-        minrec = 0
-        maxrec = 0
-        nrec = 0
-        while True:
-            for i in range(nentries):
-                line = f.readline().strip()
-                if not line:
-                    break
-                line = line.split()
-                nbox = int(line[0])-1
-                xbox = float(line[1])
-                ybox = float(line[2])
-                atbox = float(line[3])
-                vxbox = float(line[4])
-                vybox = float(line[5])
-                tbox = float(line[6])
-                boxes[nbox].vx += vxbox
-                boxes[nbox].vy += vybox
-                boxes[nbox].atoms += atbox
-                boxes[nbox].temp += tbox
-                if boxes[nbox].x == 0.:
-                    boxes[nbox].x = xbox
-                if boxes[nbox].y == 0.:
-                    boxes[nbox].y = ybox
-            nrec += 1
-            line = f.readline().strip()
-            if not line:
-                break
-            print(nrec, end='\r')
-        for b in boxes:
-            b.vx /= nrec
-            b.vy /= nrec
-            b.atoms /= nrec
-            b.temp /= nrec
-        return boxes
+        return "ChunkAccumulator({} chunks, {} records)".format(
+                len(self.x), self.nrec
+                )
+
+    def add(self, record):
+        # Chunk ids are unique within a record
+        ids = record[:, self.columns['chunk']].astype(np.intp) - 1
+        atoms = record[:, self.columns['atoms']]
+        for name in SUMMED:
+            values = record[:, self.columns[name]]
+            if self.weighted and name in WEIGHTED:
+                values = values*atoms
+            self.sums[name][ids] += values
+        for name in ['x', 'y']:
+            coord = getattr(self, name)
+            unset = coord[ids] == 0.
+            coord[ids[unset]] = record[unset, self.columns[name]]
+        self.nrec += 1
+
+    def average(self):
+        '''
+        Time averages of the field, as a dict of arrays.
+        Weighted averages are zero where no atom was counted.
+        '''
+        field = {'x': self.x.copy(), 'y': self.y.copy()}
+        for name in SUMMED:
+            if self.weighted and name in WEIGHTED:
+                atoms = self.sums['atoms']
+                field[name] = np.zeros(len(atoms))
+                np.divide(self.sums[name], atoms, out=field[name], where=atoms > 0.)
+            else:
+                field[name] = self.sums[name]/max(self.nrec, 1)
+        return field
+
+
+def find_columns(filename, names):
+    '''
+    Maps each quantity to its column. Names are looked up in the
+    fields of the ave header, or can be 1-based column numbers.
+    '''
+    columns = {}
+    fields = None
+    for quantity, name in names.items():
+        if name.isdigit():
+            columns[quantity] = int(name) - 1
+            continue
+        if fields is None:
+            fields = lmp_io.read_fields(filename)
+        if name not in fields:
+            raise ValueError(
+                    "Field {} not found in {} header: {}."
+                    .format(name, filename, " ".join(fields))
+                    )
+        columns[quantity] = fields.index(name)
+    return columns
+
+
+def read_file(filename, stepmin=0, stepmax=0, columns=COLUMNS, weighted=False):
+    '''
+    Returns the ChunkAccumulator of the records of filename in
+    the step window. Records are streamed, memory does not
+    depend on the number of records.
+    '''
+    acc = None
+    # Seeks through the record index if there is an up to date one
+    for step, record in lmp_io.iter_records(filename, None, stepmin, stepmax):
+        if acc is None:
+            acc = ChunkAccumulator(len(record), columns, weighted)
+        if acc.nrec % 1000 == 0:
+            logging.info(
+                    "Reading record number {:<10d}, step {:<10.2f}."
+                    .format(acc.nrec, step)
+                    )
+        acc.add(record)
+    if acc is None:
+        raise ValueError("No record found in {}.".format(filename))
+    return acc
+
+
+def velocity_field(filename, names=None, stepmin=0, stepmax=0, weighted=False):
+    '''
+    Library entry point: time averaged field of filename as a dict of
+    arrays (x, y, vx, vy, atoms, temp), in one streaming pass.
+    names maps quantities to header field names or 1-based columns.
+    '''
+    columns = COLUMNS
+    if names:
+        columns = dict(COLUMNS)
+        columns.update(find_columns(filename, names))
+    return read_file(filename, stepmin, stepmax, columns, weighted).average()
+
+
+def coarse_grain(field, nx, ny):
+    '''
+    Re-bins the occupied chunks of field onto a nx*ny grid over
+    the reduced box. Velocities and temperature are averaged
+    weighted by the atom count, density is the mean atom count
+    of the chunks of a cell. Returns reduced cell centers and a
+    dict of (ny, nx) arrays, NaN in empty cells.
+    '''
+    occupied = field['atoms'] > 0.
+    atoms = field['atoms'][occupied]
+    ix = np.clip((field['x'][occupied]*nx).astype(np.intp), 0, nx-1)
+    iy = np.clip((field['y'][occupied]*ny).astype(np.intp), 0, ny-1)
+    cell = iy*nx + ix
+    count = np.bincount(cell, minlength=nx*ny)
+    mass = np.bincount(cell, weights=atoms, minlength=nx*ny)
+    grid = {}
+    for name in WEIGHTED:
+        total = np.bincount(cell, weights=atoms*field[name][occupied], minlength=nx*ny)
+        grid[name] = np.full(nx*ny, np.nan)
+        np.divide(total, mass, out=grid[name], where=mass > 0.)
+    grid['density'] = np.full(nx*ny, np.nan)
+    np.divide(mass, count, out=grid['density'], where=count > 0)
+    for name in grid:
+        grid[name] = grid[name].reshape(ny, nx)
+    xc = (np.arange(nx) + 0.5)/nx
+    yc = (np.arange(ny) + 0.5)/ny
+    return xc, yc, grid
 
 
 def main():
 
-    boxes = read_file("vel.bin.ave")
-    lx = 456.4354645876385
-    ly = 54.772255750516614
+    parser = argparse.ArgumentParser(
+        description="Plots the velocity field of a LAMMPS ave/chunk 2d bin output."
+    )
+    parser.add_argument(
+        "-f",
+        "--file",
+        dest="infile",
+        default="vel.bin.ave",
+        help="File to read [default %(default)s]",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="outfile",
+        default="toto.pdf",
+        help="Output figure [default %(default)s]",
+    )
+    parser.add_argument(
+        "--lx",
+        dest="lx",
+        default=456.4354645876385,
+        type=float,
+        help="Box length along x [default %(default)s]",
+    )
+    parser.add_argument(
+        "--ly",
+        dest="ly",
+        default=54.772255750516614,
+        type=float,
+        help="Box length along y [default %(default)s]",
+    )
+    parser.add_argument(
+        "--smin",
+        dest="stepmin",
+        default=0,
+        type=int,
+        help="Minimum step to consider [default %(default)s]"
+        )
+    parser.add_argument(
+        "--smax",
+        dest="stepmax",
+        default=0,
+        type=int,
+        help="Maximum step to consider, 0 for all [default %(default)s]"
+        )
+    parser.add_argument(
+        "-w",
+        "--weighted",
+        dest="weighted",
+        action="store_true",
+        help="Weight velocities and temperature by the atom count.",
+    )
+    for quantity, default in [
+            ('chunk', '1'),
+            ('x', '2'),
+            ('y', '3'),
+            ('atoms', '4'),
+            ('vx', '5'),
+            ('vy', '6'),
+            ('temp', '7'),
+            ]:
+        parser.add_argument(
+            "--{}".format(quantity),
+            dest=quantity,
+            default=default,
+            help="Header field or 1-based column of {} [default %(default)s]"
+            .format(quantity),
+        )
+    parser.add_argument(
+        "-a",
+        "--arrows",
+        dest="arrows",
+        default=0,
+        type=int,
+        help="Number of arrows along x, chunks are coarse grained onto "
+        "that grid. 0 for one arrow per chunk [default %(default)s]",
+    )
+    parser.add_argument(
+        "-b",
+        "--background",
+        dest="background",
+        default=None,
+        choices=['temp', 'density'],
+        help="Rasterized heatmap drawn under the arrows.",
+    )
+    parser.add_argument(
+        "--raster",
+        dest="raster",
+        default=400,
+        type=int,
+        help="Heatmap pixels along x [default %(default)s]",
+    )
+    parser.add_argument(
+        "--rasterize",
+        dest="rasterize",
+        action="store_true",
+        help="Also rasterize the arrows in vector outputs.",
+    )
+    parser.add_argument(
+        "--dpi",
+        dest="dpi",
+        default=600,
+        type=int,
+        help="Output resolution [default %(default)s]",
+    )
+    parser.add_argument(
+        "-c",
+        "--cmap",
+        dest="cmap",
+        default="jet",
+        help="Colormap [default %(default)s]",
+    )
+    args = parser.parse_args()
+
+    names = {q: getattr(args, q) for q in COLUMNS}
+    try:
+        field = velocity_field(
+                args.infile, names, args.stepmin, args.stepmax, args.weighted
+                )
+    except ValueError as e:
+        raise SystemExit(e)
+    lx = args.lx
+    ly = args.ly
     ratio = lx/ly
     circle_coord = (lx/2., ly/2.)
     circle = plt.Circle(circle_coord, 10, color='#FF000030')
     fig1, ax1 = plt.subplots(figsize=(16,16/ratio))
-    x  = np.array([b.x*lx for b in boxes if b.atoms > 0.])
-    y  =  np.array([b.y*ly for b in boxes if b.atoms > 0.])
-    vx = np.array([b.vx for b in boxes if b.atoms > 0.])
-    vy = np.array([b.vy for b in boxes if b.atoms > 0.])
-    t  = np.array([b.temp for b in boxes if b.atoms > 0.])
-    ax1.quiver(x, y, vx, vy, t, cmap='jet') # , scale=1., scale_units='xy')
+    if args.background:
+        nx = args.raster
+        ny = max(1, round(nx/ratio))
+        xc, yc, grid = coarse_grain(field, nx, ny)
+        image = ax1.imshow(
+                grid[args.background],
+                origin='lower',
+                extent=(0., lx, 0., ly),
+                cmap=args.cmap,
+                interpolation='nearest',
+                aspect='auto',
+                )
+        fig1.colorbar(image, ax=ax1, label=args.background)
+    if args.arrows:
+        nx = args.arrows
+        ny = max(1, round(nx/ratio))
+        xc, yc, grid = coarse_grain(field, nx, ny)
+        x, y = np.meshgrid(xc*lx, yc*ly)
+        occupied = np.isfinite(grid['vx'])
+        x = x[occupied]
+        y = y[occupied]
+        vx = grid['vx'][occupied]
+        vy = grid['vy'][occupied]
+        t = grid['temp'][occupied]
+    else:
+        occupied = field['atoms'] > 0.
+        x = field['x'][occupied]*lx
+        y = field['y'][occupied]*ly
+        vx = field['vx'][occupied]
+        vy = field['vy'][occupied]
+        t = field['temp'][occupied]
+    if args.background:
+        # Colors are already given by the heatmap
+        ax1.quiver(x, y, vx, vy, color='k', rasterized=args.rasterize)
+    else:
+        ax1.quiver(x, y, vx, vy, t, cmap=args.cmap, rasterized=args.rasterize) # , scale=1., scale_units='xy')
     # ax1.add_patch(circle)
-    plt.savefig('toto.pdf', format='pdf', dpi=600)
+    plt.savefig(args.outfile, dpi=args.dpi)
 
     return
 
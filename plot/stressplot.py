@@ -13,47 +13,211 @@ import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 import numpy as np
 import os
+import sys
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
 
-def read_file(file):
+# lmp_io lives in the lammps directory of this repository
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'lammps'))
+try:
+    import lmp_io
+except ImportError:
+    lmp_io = None
+COMPRESSED = ('.gz', '.xz', '.zst')
+
+try:
+    from skimage import measure
+except ImportError:
+    measure = None
+
+
+def read_records(f, stepmin=0, stepmax=0):
+    '''
+    Yields the rows of each record of an opened ave/chunk file
+    in the step window, as a (nline, nfields) array.
+    '''
+    while True:
+        # Looking for the first line of a new entry, else break.
+        line = f.readline().split()
+        if not line:
+            break
+        # These values can be exported as float
+        # by LAMMPS to save space on big numbers
+        timestep, nline, natoms = list(map(float, line))
+        nline = int(nline)
+        if stepmax and timestep > stepmax:
+            break
+        block = "".join([f.readline() for _ in range(nline)])
+        if stepmin and timestep < stepmin:
+            continue
+        yield np.array(block.split(), dtype=float).reshape(nline, -1)
+
+
+def sum_records(records, file):
+    '''
+    Number of records and sum of their rows.
+    '''
     nentries = 0
+    total = None
+    for record in records:
+        if total is None:
+            total = np.zeros(record.shape)
+        elif record.shape != total.shape:
+            raise SystemExit("Number of bins changes along file {}.".format(file))
+        total += record
+        nentries += 1
+    return nentries, total
+
+
+def read_file(file, stepmin=0, stepmax=0):
+    '''
+    Average of every field over the records of the step window.
+    Records are added one at a time to a single (nline, nfields)
+    array, so memory does not grow with the trajectory length.
+    '''
+    if lmp_io is None and file.endswith(COMPRESSED):
+        raise SystemExit("Reading compressed file {} needs lmp_io.".format(file))
     try:
-        with open(file, 'r') as f:
-            f.readline() # Junk
-            f.readline() # Kind of junk too
-            fields = f.readline().split()[1:]
-            data = {}
-            for field in fields:
-                data[field] = []
-
-            while True:
-                # Looking for the first line of a new entry, else break.
-                line = f.readline().split()
-                if not line:
-                    break
-                # These values can be exported as float
-                # by LAMMPS to save space on big numbers
-                timestep, nline, natoms = list(map(float, line))
-                nline = int(nline)
-
-                for _ in range(nline):
-                    line = list(map(float, f.readline().split()))
-                    for l, (field, value) in enumerate(zip(fields, line)):
-                        if nentries:
-                            data[field][l] += value
-                        else:
-                            data[field].append(value)
-                if nentries == 0:
-                    for field in data.keys():
-                        data[field] = np.array(data[field])
-                nentries += 1
-            for field in data.keys():
-                data[field] /= nentries
-            return data
+        if lmp_io is not None:
+            # lmp_io also reads compressed files, and seeks through
+            # the record index if there is an up to date one
+            fields = lmp_io.read_fields(file)
+            records = (rec for step, rec in lmp_io.iter_records(
+                file, len(fields), stepmin, stepmax
+                ))
+            nentries, total = sum_records(records, file)
+        else:
+            with open(file) as f:
+                f.readline() # Junk
+                f.readline() # Kind of junk too
+                fields = f.readline().split()[1:]
+                nentries, total = sum_records(read_records(f, stepmin, stepmax), file)
     except IOError:
         if os.path.isfile(file):
             raise SystemExit("Something went wrong when reading file")
         else:
             raise SystemExit("File {} does not exists.".format(file))
+    except ValueError:
+        raise SystemExit("Truncated or ragged record in file {}.".format(file))
+    if not nentries:
+        raise SystemExit("No record between steps {} and {}.".format(stepmin, stepmax))
+    total /= nentries
+    return {field: total[:, i] for i, field in enumerate(fields)}
+
+COORDS = ["Coord1", "Coord2", "Coord3"]
+
+
+def voxel_index(data):
+    '''
+    Flat voxel index of each row from its Coord1..3 bins, the grid
+    shape and the bin centers along each axis. Computed once and
+    shared by all the fields.
+    '''
+    inverse = []
+    centers = []
+    for coord in COORDS:
+        if coord in data.keys():
+            # Cheaper than np.unique(return_inverse) with few bins
+            values = np.unique(data[coord])
+            inverse.append(np.searchsorted(values, data[coord]))
+            centers.append(values)
+    shape = tuple(len(c) for c in centers)
+    return np.ravel_multi_index(inverse, shape), shape, centers
+
+
+def to_volume(values, flat, shape):
+    '''
+    Scatters one field onto the grid, NaN where no row falls.
+    '''
+    volume = np.full(np.prod(shape), np.nan)
+    volume[flat] = values
+    return volume.reshape(shape)
+
+
+AXES = ['x', 'y', 'z']
+MODES = ['voxels', 'slice', 'mean', 'max', 'iso']
+VOXELS_WARNING = 50**3  # ax.voxels gets very slow above
+
+
+def extent(centers):
+    '''
+    Edges of the first and last bins.
+    '''
+    half = 0.5*(centers[-1] - centers[0])/max(len(centers) - 1, 1) or 0.5
+    return centers[0] - half, centers[-1] + half
+
+
+def plane(volume, mode, axis, index):
+    '''
+    2d view of volume: slice at index along axis, or mean/max
+    projection along axis ignoring empty (NaN) voxels.
+    '''
+    if mode == 'slice':
+        return np.take(volume, index, axis=axis)
+    with warnings.catch_warnings():
+        # All NaN columns are expected
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        if mode == 'mean':
+            return np.nanmean(volume, axis=axis)
+        return np.nanmax(volume, axis=axis)
+
+
+def render_field(name, volume, centers, mode, axis, index, level, cmap_name, outfile, dpi):
+    '''
+    Renders one field to its own file. Empty voxels are NaN.
+    Runs in the workers of the process pool, hence no pyplot.
+    '''
+    fig = Figure()
+    values = volume[np.isfinite(volume)]
+    if not values.size:
+        return "{}: no occupied voxel, skipped.".format(name)
+    norm = matplotlib.colors.Normalize(vmin=values.min(), vmax=values.max())
+    cmap = matplotlib.colormaps[cmap_name]
+    if mode == 'voxels':
+        ax = fig.add_subplot(projection='3d')
+        voxels = np.isfinite(volume)
+        facecolors = cmap(norm(np.nan_to_num(volume)))
+        ax.voxels(voxels, facecolors=facecolors, edgecolor='k')
+    elif mode == 'iso':
+        if level is None:
+            level = values.mean()
+        # Empty voxels are pushed below the level
+        filled = np.where(np.isfinite(volume), volume, values.min() - 1.)
+        spacing = [(c[-1] - c[0])/max(len(c) - 1, 1) for c in centers]
+        verts, faces, _, _ = measure.marching_cubes(filled, level, spacing=spacing)
+        verts += [c[0] for c in centers]
+        ax = fig.add_subplot(projection='3d')
+        ax.plot_trisurf(
+                verts[:, 0], verts[:, 1], faces, verts[:, 2],
+                color=cmap(norm(level)), lw=0
+                )
+        ax.set_title("{} = {:g}".format(name, level))
+    else:
+        ax = fig.add_subplot()
+        image = plane(volume, mode, axis, index)
+        kept = [i for i in range(3) if i != axis]
+        left, right = extent(centers[kept[0]])
+        bottom, top = extent(centers[kept[1]])
+        im = ax.imshow(
+                image.T,
+                origin='lower',
+                extent=(left, right, bottom, top),
+                cmap=cmap,
+                norm=norm,
+                interpolation='nearest',
+                aspect='auto',
+                )
+        ax.set_xlabel(AXES[kept[0]])
+        ax.set_ylabel(AXES[kept[1]])
+        if mode == 'slice':
+            ax.set_title("{} at {} = {:g}".format(name, AXES[axis], centers[axis][index]))
+        else:
+            ax.set_title("{} {} along {}".format(name, mode, AXES[axis]))
+        fig.colorbar(im, ax=ax)
+    fig.savefig(outfile, dpi=dpi)
+    return "{} written.".format(outfile)
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -85,63 +249,118 @@ def main():
         "-t",
         "--atom-threshold",
         dest="threshold",
-        default="1.",
-        help="Average of atoms (Ncount) below which bins are not ploted."
+        default=1.,
+        type=float,
+        help="Average of atoms (Ncount) below which bins are not ploted "
+        "[default %(default)s]"
+        )
+    parser.add_argument(
+        "--smin",
+        dest="stepmin",
+        default=0,
+        type=int,
+        help="Minimum step to consider [default %(default)s]"
+        )
+    parser.add_argument(
+        "--smax",
+        dest="stepmax",
+        default=0,
+        type=int,
+        help="Maximum step to consider, 0 for all [default %(default)s]"
+        )
+    parser.add_argument(
+        "-m",
+        "--mode",
+        dest="mode",
+        default="voxels",
+        choices=MODES,
+        help="voxels (small grids only), slice, mean or max projection, "
+        "iso surface (needs scikit-image) [default %(default)s]"
+        )
+    parser.add_argument(
+        "-a",
+        "--axis",
+        dest="axis",
+        default="z",
+        choices=AXES,
+        help="Axis normal to the slice or projected along [default %(default)s]"
+        )
+    parser.add_argument(
+        "-i",
+        "--index",
+        dest="index",
+        default=None,
+        type=int,
+        help="Bin index of the slice [default middle]"
+        )
+    parser.add_argument(
+        "-l",
+        "--level",
+        dest="level",
+        default=None,
+        type=float,
+        help="Iso surface value [default field mean]"
+        )
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="output",
+        default="crap",
+        help="Output prefix, fields go to PREFIX_field.png [default %(default)s]"
+        )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        default=os.cpu_count(),
+        type=int,
+        help="Fields rendered in parallel [default %(default)s]"
+        )
+    parser.add_argument(
+        "--dpi",
+        dest="dpi",
+        default=300,
+        type=int,
+        help="Output resolution [default %(default)s]"
         )
     args = parser.parse_args()
 
-    data = read_file(args.filename)
+    data = read_file(args.filename, args.stepmin, args.stepmax)
+
+    if args.mode == 'iso' and measure is None:
+        raise SystemExit("Iso surfaces need scikit-image.")
 
-    # Get the number of coordinates for binned plot
-    dim = []
-    cmap_name = args.cmap_name
-    for Coord in ["Coord1", "Coord2", "Coord3"]:
-        if Coord in data.keys():
-            dim.append(len(np.unique(data[Coord])))
-    x, y, z = np.indices(dim)
-    natoms = data['Ncount']
-    voxels = (x >= 0) & (y >= 0) & (z >= 0)
+    flat, shape, centers = voxel_index(data)
+    natoms = to_volume(data['Ncount'], flat, shape)
+    occupied = natoms >= args.threshold
+    if args.mode == 'voxels' and np.prod(shape) > VOXELS_WARNING:
+        print("{} voxels, consider --mode slice/mean/max.".format(np.prod(shape)))
+    axis = AXES.index(args.axis)
+    if axis >= len(shape):
+        raise SystemExit("No {} axis in {} bins.".format(args.axis, len(shape)))
+    index = args.index
+    if index is None:
+        index = shape[axis]//2
+    elif not 0 <= index < shape[axis]:
+        raise SystemExit("Slice index {} out of range, {} bins along {}.".format(
+            index, shape[axis], args.axis
+            ))
 
     # number of interesting columns
-    to_skip = len(dim)+2
+    to_skip = len(shape)+2
     mykeys = list(data)[to_skip:]
-    for k in mykeys:
-        xbin = ybin = zbin = 0
-        colors = np.zeros(voxels.shape)
-
-        norm = matplotlib.colors.Normalize(vmin=min(data[k]), vmax=max(data[k]))
-        for d in data[k]:
-            colors[xbin, ybin, zbin] = d
-            zbin += 1
-            if zbin == voxels.shape[2]:
-                zbin = 0
-                ybin += 1
-                if ybin == voxels.shape[1]:
-                    ybin = 0
-                    xbin += 1
-
-        facecolors = plt.get_cmap(cmap_name)(norm(colors))
-        xbin = ybin = zbin = 0
-        for nat in natoms:
-            if nat < 1.:
-                voxels[xbin, ybin, zbin] = False
-            zbin += 1
-            if zbin == voxels.shape[2]:
-                zbin = 0
-                ybin += 1
-                if ybin == voxels.shape[1]:
-                    ybin = 0
-                    xbin += 1
-
-        ax = plt.figure().add_subplot(projection='3d')
-        # ax.set_title(k+" Ave: {:6.4f} pm {:6.4f}".format(np.mean(data[k]), np.std(data[k])))
-        ax.voxels(voxels, facecolors=facecolors, edgecolor='k')
-        # m = cm.ScalarMappable(cmap=cmap_name, norm=norm)
-        # m.set_array([])
-        # plt.colorbar(m)
-
-    # plt.show()
-    plt.savefig('crap.png', dpi=300)
+    with ProcessPoolExecutor(max_workers=max(1, min(args.jobs, len(mykeys)))) as pool:
+        futures = []
+        for k in mykeys:
+            # Fresh mask for each field
+            volume = np.where(occupied, to_volume(data[k], flat, shape), np.nan)
+            outfile = "{}_{}.png".format(args.output, k)
+            futures.append(pool.submit(
+                render_field, k, volume, centers, args.mode, axis, index,
+                args.level, args.cmap_name, outfile, args.dpi
+                ))
+        for future in futures:
+            print(future.result())
 
 if __name__ == "__main__":
     try: